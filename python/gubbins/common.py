@@ -245,9 +245,9 @@ def parse_and_run(input_args, program_description=""):
                 alignment_filename = base_filename + ".start"
                 alignment_type = 'fasta' # input starting polymorphism alignment file assumed to be fasta format
                 polymorphism_alignment = read_alignment(alignment_filename, alignment_type, verbose = input_args.verbose)
-                base_pattern_bases_array, base_pattern_positions_array = get_base_patterns(polymorphism_alignment,
-                                                                                            input_args.verbose,
-                                                                                            threads = input_args.threads)
+                base_pattern_bases_array, base_pattern_positions_array, base_pattern_boundaries_array = \
+                    get_base_patterns(polymorphism_alignment,
+                                      input_args.verbose)
 
             # 3.4a. Re-fit full polymorphism alignment to new tree
             model_fitting_command = model_fitter.model_fitting_command(snp_alignment_filename,
@@ -267,6 +267,7 @@ def parse_and_run(input_args, program_description=""):
             jar(alignment = polymorphism_alignment, # complete polymorphism alignment
                 base_patterns = base_pattern_bases_array, # array of unique base patterns in alignment
                 base_pattern_positions = base_pattern_positions_array, # nparray of positions of unique base patterns in alignment
+                base_pattern_boundaries = base_pattern_boundaries_array, # nparray of where each base pattern's positions start and end
                 tree_filename = recontree_filename, # tree generated by model fit
                 info_filename = info_filename, # file containing evolutionary model parameters
                 info_filetype = input_args.model_fitter, # model fitter - format of file containing evolutionary model parameters
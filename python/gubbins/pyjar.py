@@ -4,33 +4,28 @@
 # code modified from https://github.com/simonrharris/pyjar
 # pyjar is free software, licensed under GPLv3.
 
-from scipy import linalg
 import numpy
 import dendropy
 import sys
 import os
 import time
 from Bio import AlignIO
-from math import log, exp
-from functools import partial
 import numba
-from numba import jit, njit, types, from_dtype
-import collections
-try:
-    from multiprocessing import Pool, shared_memory
-    from multiprocessing.managers import SharedMemoryManager
-    NumpyShared = collections.namedtuple('NumpyShared', ('name', 'shape', 'dtype'))
-except ImportError as e:
-    sys.stderr.write("This version of Gubbins requires the multiprocessing library and python v3.8 or higher for memory management\n")
-    sys.exit(201)
-
-from gubbins.utils import generate_shared_mem_array
+from numba import jit, njit, prange, types, from_dtype
+
+# Gubbins forks whenever it runs an external program, which is unsafe after the
+# GNU OpenMP threading layer has been used; select a fork-safe layer (TBB, or
+# OpenMP where forking is supported, otherwise workqueue) unless another
+# has been explicitly requested
+if numba.config.THREADING_LAYER == 'default':
+    numba.config.THREADING_LAYER = 'forksafe'
 
 ###########################
 # Python-native functions #
 ###########################
 
-# Split a list into chunks for multiprocessing
+# Split base patterns into contiguous chunks, one for each thread of the
+# prange loop in iterate_over_base_pattern_chunks
 # from https://stackoverflow.com/questions/2130016/splitting-a-list-into-n-parts-of-approximately-equal-length/37414115#37414115
 def chunks(l, k):
     n = len(l)
@@ -47,14 +42,23 @@ def read_tree(treefile):
                         rooting="force-rooted")
     return t
 
-#Calculate Pij from Q matrix and branch length
-def calculate_pij(branch_length,rate_matrix):
-    if branch_length==0:
-        pij = numpy.full((4,4), numpy.NINF, dtype = numpy.float32)
-        numpy.fill_diagonal(pij, 0.0)
-    else:
-        pij = numpy.array(numpy.log(linalg.expm(numpy.multiply(branch_length,rate_matrix))), dtype = numpy.float32) # modified
-    return pij.flatten()
+# Calculate log transition probability matrices (pij) for all branch lengths at once
+# from a single eigendecomposition of the Q matrix: P(t) = I + V.diag(expm1(lambda*t)).V^-1
+# Using expm1 keeps the small off-diagonal probabilities of short branches accurate,
+# and gives exactly the identity for zero-length branches
+def calculate_log_transition_probabilities(branch_lengths,rate_matrix):
+    # Branches of the same length share a matrix, so each length is only calculated once
+    unique_branch_lengths, branch_length_indices = numpy.unique(branch_lengths, return_inverse = True)
+    eigenvalues, eigenvectors = numpy.linalg.eig(numpy.array(rate_matrix, dtype = numpy.float64))
+    inverse_eigenvectors = numpy.linalg.inv(eigenvectors)
+    expm1_eigenvalues = numpy.expm1(numpy.outer(unique_branch_lengths,eigenvalues))
+    transition_probabilities = numpy.identity(4) + numpy.einsum('ij,bj,jk->bik',
+                                                                eigenvectors,
+                                                                expm1_eigenvalues,
+                                                                inverse_eigenvectors).real
+    # Probabilities are floored so that every change of base has a finite log likelihood
+    pij = numpy.log(numpy.maximum(transition_probabilities, 1e-300))
+    return pij.astype(numpy.float32)[branch_length_indices]
 
 # Create an instanteous rate matrix
 def create_rate_matrix(f, r):
@@ -161,30 +165,14 @@ def read_info(infofile, type = 'raxml'):
 
     return numpy.array(f, dtype = numpy.float32), numpy.array(r, dtype = numpy.float32)
 
-# Convert arrays of variable-length arrays to a square matrix
-# for compatibility with numba
-# from https://stackoverflow.com/questions/32037893/numpy-fix-array-with-rows-of-different-lengths-by-filling-the-empty-elements-wi
-def convert_to_square_numpy_array(data):
-    # Get lengths of each row of data
-    lens = numpy.array([len(i) for i in data])
-
-    # Mask of valid places in each row
-    mask = numpy.arange(lens.max()) < lens[:,None]
-
-    # Setup output array and put elements from data into masked positions
-    out = numpy.full(mask.shape, -1, dtype = numpy.int32)
-    out[mask] = numpy.concatenate(data)
-    return out
-
-# Read in sequence to enable conversion to integers with JIT function
-def process_sequence(index_list,alignment = None,codec = None,align_array = None):
-    # Load shared memory output alignment
-    out_aln_shm = shared_memory.SharedMemory(name = align_array.name)
-    out_aln = numpy.ndarray(align_array.shape, dtype = numpy.uint8, buffer = out_aln_shm.buf)
-    for i in index_list:
-        # Add sequence
-        unicode_seq = numpy.frombuffer(bytearray(str(alignment[i].seq), codec), dtype = 'U1')
-        seq_to_int(unicode_seq,out_aln[i])
+# Lookup table converting ASCII characters to base indices - any character
+# other than A, C, G or T is treated as an unknown base
+base_lookup_table = numpy.full(256, 4, dtype = numpy.uint8)
+for base_index,base in enumerate('ACGT'):
+    base_lookup_table[ord(base)] = base_index
+
+# Lookup table converting base indices back to ASCII characters
+base_decoding_table = numpy.frombuffer(b'ACGT-', dtype = numpy.uint8)
 
 # Function to read an alignment in various formats
 def read_alignment(filename, file_type, verbose=False):
@@ -203,80 +191,81 @@ def read_alignment(filename, file_type, verbose=False):
         sys.exit(203)
     return alignmentObject
 
-# Get the unique base patterns within the numpy array
+# Get the unique base patterns within the numpy array, returned as rows
 # Based on https://stackoverflow.com/questions/21888406/getting-the-indexes-to-the-duplicate-columns-of-a-numpy-array
 def get_unique_columns(data):
+    # View each column as a single contiguous block of bytes
     dt = numpy.dtype((numpy.void, data.dtype.itemsize * data.shape[0]))
-    dataf = numpy.asfortranarray(data).view(dt)
-    u,uind = numpy.unique(dataf, return_inverse=True)
-    u = u.view(data.dtype).reshape(-1,data.shape[0]).T
-    return (u,uind)
+    datat = numpy.ascontiguousarray(data.T).view(dt).ravel()
+    u,uind = numpy.unique(datat, return_inverse=True)
+    u = u.view(data.dtype).reshape(-1,data.shape[0])
+    return (u,uind.ravel())
 
 ##########################
 # JIT-compiled functions #
 ##########################
 
-# Convert bases to integers
-###########################
-@njit(numba.void(numba.typeof(numpy.dtype('U1'))[:],
-                numba.uint8[:]),
-                cache = True)
-def seq_to_int(seq,out_seq):
-    for i,b in enumerate(seq):
-        if b == 'A':
-            out_seq[i] = 0
-        elif b == 'C':
-            out_seq[i] = 1
-        elif b == 'G':
-            out_seq[i] = 2
-        elif b == 'T':
-            out_seq[i] = 3
-        elif b == '-':
-            out_seq[i] = 4
-        elif b == 'N':
-            out_seq[i] = 5
-        else:
-            print('Unable to process character',b)
-
 # Calculate most likely base given bases in descendents
 #######################################################
 @njit(numba.void(numba.float32[:,:],
                 numba.uint8[:,:],
                 numba.float32[:,::1],
                 numba.int32,
-                numba.int32[:,:],
+                numba.int32[:],
+                numba.int32[:],
                 numba.uint8[::1]),
                 cache=True)
-def find_most_likely_base_given_descendents(Lmat, Cmat, pij, node_index, child_nodes, column_base_indices):
+def find_most_likely_base_given_descendents(Lmat, Cmat, pij, node_index, child_node_indptr, child_node_indices, column_base_indices):
     #2a. Lz(i) = maxj Pij(tz) x Lx(j) x Ly(j)
     #2b. Cz(i) = the value of j attaining the above maximum.
-    child_node_indices = child_nodes[node_index,:]
-    child_node_indices = child_node_indices[child_node_indices > -1]
-    for end_index in column_base_indices:
-        c = Lmat[child_node_indices,end_index].sum()
-        for start_index in column_base_indices:
-            j = pij[start_index,end_index]+c
-            if j > Lmat[node_index,start_index]:
-                Lmat[node_index,start_index] = j
-                Cmat[node_index,start_index] = end_index
+    # Sum descendent likelihoods for each end base in a single pass over the children
+    c0 = c1 = c2 = c3 = numpy.float32(0.0)
+    for child_node_index in child_node_indices[child_node_indptr[node_index]:child_node_indptr[node_index+1]]:
+        c0 += Lmat[child_node_index,0]
+        c1 += Lmat[child_node_index,1]
+        c2 += Lmat[child_node_index,2]
+        c3 += Lmat[child_node_index,3]
+    c = (c0, c1, c2, c3)
+    # Score each start base against each end base, keeping the running maximum
+    for start_index in column_base_indices:
+        max_score = numpy.float32(numpy.NINF)
+        max_base = start_index
+        for i,end_index in enumerate(column_base_indices):
+            score = pij[start_index,end_index] + c[end_index]
+            if i == 0 or score > max_score:
+                max_score = score
+                max_base = end_index
+        if max_score > Lmat[node_index,start_index]:
+            Lmat[node_index,start_index] = max_score
+            Cmat[node_index,start_index] = max_base
 
 # Calculate the most likely base at the root node
 #################################################
-@njit(numba.void(numba.float32[:,:],
-                numba.uint8[:,:],
+@njit(numba.uint8(numba.float32[:,:],
                 numba.float32[:],
                 numba.int32,
                 numba.int32[:],
+                numba.int32[:],
                 numba.uint8[:]),
                 cache=True)
-def calculate_root_likelihood(Lmat, Cmat, base_frequencies, node_index, child_node_indices, column_base_indices):
-    for end_index in column_base_indices:
-        c = Lmat[child_node_indices,end_index].sum()
-        for start_index in column_base_indices:
-            j = log(base_frequencies[end_index]) + c
-            if j > Lmat[node_index,start_index]:
-                Lmat[node_index,start_index] = j
-                Cmat[node_index,start_index] = end_index
+def calculate_root_likelihood(Lmat, log_base_frequencies, node_index, child_node_indptr, child_node_indices, column_base_indices):
+    # Root likelihoods do not depend on the start base, so the most likely
+    # root base is found with a single pass over the observed bases
+    max_score = numpy.float32(numpy.NINF)
+    max_base = numpy.uint8(0)
+    for i,end_index in enumerate(column_base_indices):
+        c = numpy.float32(0.0)
+        for child_node_index in child_node_indices[child_node_indptr[node_index]:child_node_indptr[node_index+1]]:
+            c += Lmat[child_node_index,end_index]
+        score = log_base_frequencies[end_index] + c
+        if i == 0 or score > max_score:
+            max_score = score
+            max_base = end_index
+    # Default to the first base if no reconstruction has a finite likelihood
+    if max_score > numpy.NINF:
+        return max_base
+    else:
+        return numpy.uint8(0)
 
 # Fill in matrices given known or unknown base in sequence
 ##########################################################
@@ -301,118 +290,87 @@ def process_leaf(Lmat, Cmat, pij, node_index, taxon_base_index):
 @njit(numba.void(numba.int32[:],
                 numba.int32[:],
                 numba.int32[:],
-                numba.int32,
-                numba.uint8[:],
+                numba.uint8[:,:],
                 numba.int32[:]),
                 cache=True)
-def count_node_snps(node_snps,preordered_nodes,parent_nodes,seed_node,reconstructed_alleles,base_pattern_columns):
+def count_node_snps(node_snps,preordered_nodes,parent_nodes,pattern_alleles,pattern_weights):
+    # Compare the alleles at every node and its parent for each base pattern in the chunk;
+    # each base pattern counts once for every alignment column in which it occurs
     # Note that preordered node list does not include the root
-    for node_index in preordered_nodes:
-        parent_node_index = parent_nodes[node_index]
-        if reconstructed_alleles[node_index] < 4 and reconstructed_alleles[parent_node_index] < 4 \
-          and reconstructed_alleles[node_index] != reconstructed_alleles[parent_node_index]:
-            node_snps[node_index] += len(base_pattern_columns)
+    for pattern_index in range(pattern_alleles.shape[0]):
+        reconstructed_alleles = pattern_alleles[pattern_index,:]
+        for node_index in preordered_nodes:
+            parent_node_index = parent_nodes[node_index]
+            if reconstructed_alleles[node_index] < 4 and reconstructed_alleles[parent_node_index] < 4 \
+              and reconstructed_alleles[node_index] != reconstructed_alleles[parent_node_index]:
+                node_snps[node_index] += pattern_weights[pattern_index]
 
 # Reconstruct missing data at internal nodes
 ############################################
 @njit(numba.void(numba.uint8[:],
                 numba.int32[:],
-                numba.int32[:],
+                numba.boolean[:],
                 numba.int32[:],
                 numba.uint8[:],
-                numba.int32[:,:],
+                numba.int32[:],
+                numba.int32[:],
                 numba.uint8[:]),
                 cache=True)
 def reconstruct_alleles(reconstructed_alleles,
                         postordered_nodes,
-                        leaf_nodes,
+                        leaf_node_mask,
                         node_index_to_aln_row,
                         column,
-                        child_nodes,
+                        child_node_indptr,
+                        child_node_indices,
                         reconstructed_base_indices):
     for node_index in postordered_nodes:
-        if node_index in leaf_nodes:
+        if leaf_node_mask[node_index]:
             alignment_index = node_index_to_aln_row[node_index]
             reconstructed_alleles[node_index] = column[alignment_index]
         else:
             has_child_base = False
-            for child_taxon_index in child_nodes[node_index,:]:
-                if child_taxon_index > -1:
-                    if reconstructed_alleles[child_taxon_index] < 4:
-                        has_child_base = True
+            for child_taxon_index in child_node_indices[child_node_indptr[node_index]:child_node_indptr[node_index+1]]:
+                if reconstructed_alleles[child_taxon_index] < 4:
+                    has_child_base = True
             if has_child_base:
                 reconstructed_alleles[node_index] = reconstructed_base_indices[node_index]
             else:
                 reconstructed_alleles[node_index] = numpy.uint8(4)
 
-# Transfer reconstructed alleles into alignment
-###############################################
-@njit(numba.void(numba.typeof(numpy.dtype('U1'))[:,:],
-                numba.uint8[:],
-                numba.typeof(numpy.dtype('U1'))[:],
-                numba.int32[:],
-                numba.int32[:]),
-                cache=True)
-def fill_out_aln(out_aln,reconstructed_alleles,ordered_bases,ancestral_node_order,base_pattern_columns):
-    for index in numpy.arange(ancestral_node_order.size, dtype=numpy.int32):
-        node_index = ancestral_node_order[index]
-        base_index = reconstructed_alleles[node_index]
-        base = ordered_bases[base_index]
-        for column in base_pattern_columns:
-            out_aln[column,index] = base
-
-# Return positions of columns in alignment
-##########################################
-@njit(numba.int32[:](numba.int32[:],
-                numba.int32[:,:],
-                numba.int32),
-                cache=True)
-def get_columns(base_pattern_columns_padded,column_positions,column_index):
-    base_pattern_columns_indices = numpy.argmax(base_pattern_columns_padded == -1)
-    if base_pattern_columns_indices == 0:
-        base_pattern_columns_indices = base_pattern_columns_padded.size
-    base_pattern_columns = column_positions[column_index,0:base_pattern_columns_indices]
-    return base_pattern_columns
-
 # Reconstruct each base pattern
 ###############################
 @njit(numba.void(numba.uint8[:,:],
-                numba.int32[:,:],
                 numba.float32[:,:],
                 numba.uint8[:,:],
-                numba.typeof(numpy.dtype('U1'))[:,:],
-                numba.typeof(numpy.dtype('U1'))[:],
                 numba.int32[:],
                 numba.int32[:],
                 numba.int32[:],
-                numba.int32[:,:],
-                numba.int32,
                 numba.int32[:],
                 numba.int32[:],
-                numba.float32[:,:],
+                numba.int32,
+                numba.boolean[:],
+                numba.float32[:,:,::1],
                 numba.float32[:],
                 numba.int32[:],
                 numba.uint8[:],
-                numba.int32[:]),
+                numba.uint8[:,:]),
                 cache=True)
 def iterate_over_base_patterns(columns,
-                                column_positions,
                                 Lmat,
                                 Cmat,
-                                tmp_out_aln,
-                                ordered_bases,
                                 postordered_nodes,
                                 preordered_nodes,
                                 parent_nodes,
-                                child_nodes,
+                                child_node_indptr,
+                                child_node_indices,
                                 seed_node,
-                                leaf_nodes,
-                                ancestral_node_order,
+                                leaf_node_mask,
                                 node_pij,
-                                base_frequencies,
+                                log_base_frequencies,
                                 node_index_to_aln_row,
                                 reconstructed_base_indices,
-                                node_snps):
+                                pattern_alleles):
 
     column_indices = numpy.arange(columns.shape[0], dtype = numpy.int32)
     Cmat_null = numpy.array([0,1,2,3], dtype = numpy.uint8)
@@ -422,34 +380,29 @@ def iterate_over_base_patterns(columns,
         # Get column bases
         column = columns[column_index]
         
-        # Get column positions
-        base_pattern_columns_padded = column_positions[column_index]
-        base_pattern_columns = get_columns(base_pattern_columns_padded,column_positions,column_index)
-        
-        # Reset matrices
-        Lmat.fill(numpy.NINF)
-        Cmat[:] = Cmat_null
-
-        # Count unknown bases
-        unknown_base_count = numpy.count_nonzero(column > 3)
+        # Get observed bases
         column_base_indices = numpy.unique(column[numpy.where(column <= 3)])
-          
-        # Heuristic for speed: if all taxa are monomorphic, with a gap in only one sequence, then the ancestral states
-        # will all be the observed base, as no ancestral node will have two child nodes with unknown bases at this site
-        if unknown_base_count == 1 and column_base_indices.size == 1:
-            # If site is monomorphic - replace entire column
-            tmp_out_aln[base_pattern_columns,:] = ordered_bases[column_base_indices[0]]
+
+        # Heuristic for speed: if no more than one base is observed, then every ancestral node with an observed
+        # descendent will be reconstructed as that base, and no substitutions can occur, so the ML inference can be skipped
+        if column_base_indices.size == 1:
+            reconstructed_base_indices[:] = column_base_indices[0]
+        elif column_base_indices.size == 0:
+            reconstructed_base_indices[:] = 4
         else:
             # Otherwise perform a full ML inference
+            # Reset matrices
+            Lmat.fill(numpy.NINF)
+            Cmat[:] = Cmat_null
+
             #1 For each OTU y perform the following:
             #Visit a nonroot internal node, z, which has not been visited yet, but both of whose sons, nodes x and y, have already been visited, i.e., Lx(j), Cx(j), Ly(j), and Cy(j) have already been defined for each j. Let tz be the length of the branch connecting node z and its father. For each amino acid i, compute Lz(i) and Cz(i) according to the following formulae:
             #Denote the three sons of the root by x, y, and z. For each amino acid k, compute the expression Pk x Lx(k) x Ly(k) x Lz(k). Reconstruct r by choosing the amino acid k maximizing this expression. The maximum value found is the likelihood of the best reconstruction.
-            for node_index in postordered_nodes:
-                if node_index == seed_node:
-                    continue
-                #calculate the transistion matrix for the branch
-                pij=numpy.reshape(node_pij[node_index,:].copy(),(4,4))
-                if node_index in leaf_nodes:
+            # The root is the last node in postorder, and is reconstructed separately below
+            for node_index in postordered_nodes[:-1]:
+                #get the transistion matrix for the branch
+                pij=node_pij[node_index]
+                if leaf_node_mask[node_index]:
                     alignment_index = node_index_to_aln_row[node_index]
                     taxon_base_index = column[alignment_index]
                     process_leaf(Lmat,
@@ -464,15 +417,17 @@ def iterate_over_base_patterns(columns,
                                                             Cmat,
                                                             pij,
                                                             node_index,
-                                                            child_nodes,
+                                                            child_node_indptr,
+                                                            child_node_indices,
                                                             column_base_indices)
 
             # Calculate likelihood of base at root node
-            child_node_indices = child_nodes[node_index,:]
-            child_node_indices = child_node_indices[child_node_indices > -1]
-            calculate_root_likelihood(Lmat, Cmat, base_frequencies, node_index, child_node_indices, column_base_indices)
-            max_root_base_index = Cmat[node_index,numpy.argmax(Lmat[node_index,:])]
-            reconstructed_base_indices[node_index] = max_root_base_index
+            reconstructed_base_indices[seed_node] = calculate_root_likelihood(Lmat,
+                                                                              log_base_frequencies,
+                                                                              seed_node,
+                                                                              child_node_indptr,
+                                                                              child_node_indices,
+                                                                              column_base_indices)
             
             #Traverse the tree from the root in the direction of the OTUs, assigning to each node its most likely ancestral character as follows:
             # Note that preordered node list does not include the root
@@ -483,35 +438,92 @@ def iterate_over_base_patterns(columns,
                 #5b. Reconstruct node x by choosing Cx(i).
                 reconstructed_base_indices[node_index] = Cmat[node_index,i]
 
-            # Put gaps back in and check that any ancestor with only gaps downstream is made a gap
-            # store reconstructed alleles
-            reconstructed_alleles = numpy.full(postordered_nodes.size, 8, dtype = numpy.uint8)
-            reconstruct_alleles(reconstructed_alleles,
-                                postordered_nodes,
-                                leaf_nodes,
-                                node_index_to_aln_row,
-                                column,
-                                child_nodes,
-                                reconstructed_base_indices
-                                )
-
-            # If site is not monomorphic - replace specific entries
-            fill_out_aln(tmp_out_aln,
-                        reconstructed_alleles,
-                        ordered_bases,
-                        ancestral_node_order,
-                        base_pattern_columns
-                        )
-
-            # enumerate the number of base subtitutions reconstructed occurring on each branch
-            count_node_snps(node_snps,
-                            preordered_nodes,
-                            parent_nodes,
-                            seed_node,
-                            reconstructed_alleles,
-                            base_pattern_columns,
+        # Put gaps back in and check that any ancestor with only gaps downstream is made a gap
+        # store reconstructed alleles
+        reconstructed_alleles = pattern_alleles[column_index,:]
+        reconstruct_alleles(reconstructed_alleles,
+                            postordered_nodes,
+                            leaf_node_mask,
+                            node_index_to_aln_row,
+                            column,
+                            child_node_indptr,
+                            child_node_indices,
+                            reconstructed_base_indices
                             )
 
+# Reconstruct chunks of base patterns in parallel
+#################################################
+@njit(numba.void(numba.int32[:],
+                numba.uint8[:,:],
+                numba.int32[:],
+                numba.uint8[:,:],
+                numba.int32[:],
+                numba.int32[:],
+                numba.int32[:],
+                numba.int32[:],
+                numba.int32[:],
+                numba.int32,
+                numba.boolean[:],
+                numba.float32[:,:,::1],
+                numba.float32[:],
+                numba.int32[:],
+                numba.int32[:,:]),
+                parallel=True,
+                cache=True)
+def iterate_over_base_pattern_chunks(chunk_boundaries,
+                                        base_patterns,
+                                        base_pattern_position_boundaries,
+                                        pattern_alleles,
+                                        postordered_nodes,
+                                        preordered_nodes,
+                                        parent_nodes,
+                                        child_node_indptr,
+                                        child_node_indices,
+                                        seed_node,
+                                        leaf_node_mask,
+                                        node_pij,
+                                        log_base_frequencies,
+                                        node_index_to_aln_row,
+                                        node_snps):
+
+    # Each chunk requires its own working matrices; these are allocated
+    # outside of the parallel loop so they cannot be hoisted and shared
+    num_chunks = chunk_boundaries.size - 1
+    num_nodes = postordered_nodes.size
+    Lmats = numpy.full((num_chunks,num_nodes,4), numpy.NINF, dtype = numpy.float32)
+    Cmats = numpy.zeros((num_chunks,num_nodes,4), dtype = numpy.uint8)
+    reconstructed_base_indices = numpy.full((num_chunks,num_nodes), 8, dtype = numpy.uint8)
+    pattern_weights = base_pattern_position_boundaries[1:] - base_pattern_position_boundaries[:-1]
+
+    for chunk_index in prange(num_chunks):
+
+        chunk_start = chunk_boundaries[chunk_index]
+        chunk_end = chunk_boundaries[chunk_index + 1]
+
+        # Each chunk only writes alleles to the rows of its own base patterns
+        iterate_over_base_patterns(base_patterns[chunk_start:chunk_end,:],
+                                    Lmats[chunk_index,:,:],
+                                    Cmats[chunk_index,:,:],
+                                    postordered_nodes,
+                                    preordered_nodes,
+                                    parent_nodes,
+                                    child_node_indptr,
+                                    child_node_indices,
+                                    seed_node,
+                                    leaf_node_mask,
+                                    node_pij,
+                                    log_base_frequencies,
+                                    node_index_to_aln_row,
+                                    reconstructed_base_indices[chunk_index,:],
+                                    pattern_alleles[chunk_start:chunk_end,:])
+
+        # enumerate the number of base subtitutions reconstructed occurring on each branch
+        count_node_snps(node_snps[chunk_index,:],
+                        preordered_nodes,
+                        parent_nodes,
+                        pattern_alleles[chunk_start:chunk_end,:],
+                        pattern_weights[chunk_start:chunk_end])
+
 ##################
 # Main functions #
 ##################
@@ -520,7 +532,7 @@ def iterate_over_base_patterns(columns,
 # Function for converting alignment to numpy array #
 ####################################################
 
-def get_base_patterns(alignment, verbose, threads = 1):
+def get_base_patterns(alignment, verbose):
     if verbose:
         print("Finding unique base patterns")
     # Identify unique base patterns
@@ -528,102 +540,71 @@ def get_base_patterns(alignment, verbose, threads = 1):
     # Convert alignment to Numpy array
     ntaxa = len(alignment)
     seq_length = alignment.get_alignment_length()
-    align_array = numpy.full((ntaxa,seq_length), 8, dtype = numpy.uint8, order='F')
-    # Check njit function is compiled before multiprocessing
-    try:
-        seq_to_int()
-    except:
-        pass
-    # Convert alignment to Numpy array
-    codec = 'utf-32-le' if sys.byteorder == 'little' else 'utf-32-be'
-    ntaxa_range_list = list(range(ntaxa))
-    ntaxa_range_indices = list(chunks(ntaxa_range_list,threads))
-    with SharedMemoryManager() as smm:
-        align_array_shared = generate_shared_mem_array(align_array, smm)
-        with Pool(processes = threads) as pool:
-            pool.map(partial(
-                process_sequence,
-                    alignment = alignment,
-                    codec = codec,
-                    align_array = align_array_shared
-                ),
-                ntaxa_range_indices
-            )
-        # Write out alignment while shared memory manager still active
-        align_array_shm = shared_memory.SharedMemory(name = align_array_shared.name)
-        align_array = numpy.ndarray(align_array.shape, dtype = numpy.uint8, buffer = align_array_shm.buf)
+    align_array = numpy.empty((ntaxa,seq_length), dtype = numpy.uint8)
+    for i,record in enumerate(alignment):
+        align_array[i] = numpy.frombuffer(str(record.seq).encode('ascii', 'replace'), dtype = numpy.uint8)
+    # Convert alignment to integers
+    align_array = base_lookup_table[align_array]
 
     # Get unique base patterns and their indices in the alignment
-    base_pattern_bases_array, base_pattern_positions_array = get_unique_columns(align_array)
-    base_pattern_positions_array_of_arrays = \
-        [numpy.where(base_pattern_positions_array==x)[0] for x in range(base_pattern_bases_array.shape[1])]
-
-    # Convert the array of arrays into an ndarray that can be saved to shared memory
-    square_base_pattern_positions_array = convert_to_square_numpy_array(base_pattern_positions_array_of_arrays)
+    base_pattern_bases_array, base_pattern_indices = get_unique_columns(align_array)
+    num_base_patterns = base_pattern_bases_array.shape[0]
+
+    # Group the alignment positions by base pattern - the positions of pattern i are
+    # base_pattern_positions_array[base_pattern_boundaries_array[i]:base_pattern_boundaries_array[i+1]]
+    base_pattern_positions_array = numpy.argsort(base_pattern_indices, kind = 'stable').astype(numpy.int32)
+    base_pattern_boundaries_array = numpy.zeros(num_base_patterns + 1, dtype = numpy.int32)
+    numpy.cumsum(numpy.bincount(base_pattern_indices, minlength = num_base_patterns),
+                 out = base_pattern_boundaries_array[1:])
     # Finish
     t2=time.process_time()
     if verbose:
         print("Time taken to find unique base patterns:", t2-t1, "seconds")
-        print("Unique base patterns:", str(square_base_pattern_positions_array.shape[0]))
-    return base_pattern_bases_array.transpose(), square_base_pattern_positions_array
+        print("Unique base patterns:", str(num_base_patterns))
+    return base_pattern_bases_array, base_pattern_positions_array, base_pattern_boundaries_array
 
 ########################################################
 # Function for reconstructing individual base patterns #
 ########################################################
 
-def reconstruct_alignment_column(column_indices,
-                                tree = None,
+def reconstruct_alignment_columns(num_nodes = None,
                                 preordered_nodes = None,
                                 postordered_nodes = None,
-                                leaf_nodes = None,
+                                leaf_node_mask = None,
                                 parent_nodes = None,
-                                child_nodes = None,
+                                child_node_indptr = None,
+                                child_node_indices = None,
                                 seed_node = None,
                                 node_pij = None,
                                 node_index_to_aln_row = None,
                                 ancestral_node_order = None,
                                 base_patterns = None,
                                 base_pattern_positions = None,
-                                base_frequencies = None,
+                                base_pattern_boundaries = None,
+                                log_base_frequencies = None,
                                 new_aln = None,
                                 threads = 1,
                                 verbose = False):
-    
+
     ### TIMING
     if verbose:
         prep_time = 0.0
         calc_time = 0.0
         prep_time_start = time.process_time()
 
-    # Load shared memory output alignment
-    out_aln_shm = shared_memory.SharedMemory(name = new_aln.name)
-    out_aln = numpy.ndarray(new_aln.shape, dtype = 'U1', buffer = out_aln_shm.buf)
-    
-    # Generate data structures for reconstructions
-    num_nodes = len(tree.nodes())
-    Lmat = numpy.full((num_nodes,4), numpy.NINF, dtype = numpy.float32)
-    Cmat = numpy.full((num_nodes,4), [0,1,2,3], dtype = numpy.uint8)
-    reconstructed_base_indices = numpy.full(num_nodes, 8, dtype = numpy.uint8)
-
-    # Record SNPs reconstructed as occurring on each branch
-    bases = frozenset(['A','C','G','T'])
-    ordered_bases = numpy.array(['A','C','G','T','-'], dtype = 'U1')
-    node_snps = numpy.zeros(num_nodes, dtype = numpy.int32)
-
-    # Load base pattern information
-    base_patterns_shm = shared_memory.SharedMemory(name = base_patterns.name)
-    base_patterns = numpy.ndarray(base_patterns.shape, dtype = base_patterns.dtype, buffer = base_patterns_shm.buf)
-    # Load base pattern position information
-    base_pattern_positions_shm = shared_memory.SharedMemory(name = base_pattern_positions.name)
-    base_pattern_positions = numpy.ndarray(base_pattern_positions.shape, dtype = base_pattern_positions.dtype, buffer = base_pattern_positions_shm.buf)
-
-    # Extract information for iterations
-    if threads == 1:
-        columns = base_patterns
-        column_positions = base_pattern_positions
-    else:
-        columns = base_patterns[column_indices]
-        column_positions = base_pattern_positions[column_indices,:]
+    # Set the number of threads used by the parallelised JIT function
+    numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+
+    # Split base patterns into one contiguous chunk per thread
+    bp_list = list(range(len(base_patterns)))
+    base_pattern_chunk_boundaries = numpy.cumsum([0] + [len(chunk) for chunk in chunks(bp_list,threads)],
+                                                 dtype = numpy.int32)
+
+    # Record SNPs reconstructed as occurring on each branch separately for each chunk
+    node_snps = numpy.zeros((threads,num_nodes), dtype = numpy.int32)
+
+    # Record the alleles reconstructed at every node for each base pattern
+    pattern_alleles = numpy.full((len(base_patterns),num_nodes), 4, dtype = numpy.uint8)
 
     ### TIMING
     if verbose:
@@ -631,39 +612,35 @@ def reconstruct_alignment_column(column_indices,
         prep_time = prep_time_end - prep_time_start
         calc_time_start = time.process_time()
 
-    # Iterate over columns
-    iterate_over_base_patterns(columns,
-                                column_positions,
-                                Lmat,
-                                Cmat,
-                                out_aln,
-                                ordered_bases,
-                                postordered_nodes,
-                                preordered_nodes,
-                                parent_nodes,
-                                child_nodes,
-                                seed_node,
-                                leaf_nodes,
-                                ancestral_node_order,
-                                node_pij,
-                                base_frequencies,
-                                node_index_to_aln_row,
-                                reconstructed_base_indices,
-                                node_snps)
-
+    # Iterate over chunks of columns in parallel
+    iterate_over_base_pattern_chunks(base_pattern_chunk_boundaries,
+                                        base_patterns,
+                                        base_pattern_boundaries,
+                                        pattern_alleles,
+                                        postordered_nodes,
+                                        preordered_nodes,
+                                        parent_nodes,
+                                        child_node_indptr,
+                                        child_node_indices,
+                                        seed_node,
+                                        leaf_node_mask,
+                                        node_pij,
+                                        log_base_frequencies,
+                                        node_index_to_aln_row,
+                                        node_snps)
+
+    # Expand the ancestral alleles of each base pattern to the alignment columns in which it occurs;
+    # this is done once all chunks are complete, so threads never write to the same region of the alignment
+    column_base_patterns = numpy.empty(base_pattern_positions.size, dtype = numpy.int32)
+    column_base_patterns[base_pattern_positions] = numpy.repeat(numpy.arange(len(base_patterns), dtype = numpy.int32),
+                                                                numpy.diff(base_pattern_boundaries))
+    ancestral_alleles = numpy.ascontiguousarray(pattern_alleles[:,ancestral_node_order].T)
+    numpy.take(ancestral_alleles, column_base_patterns, axis = 1, out = new_aln)
 
     ### TIMING
     if verbose:
         calc_time_end = time.process_time()
         calc_time = (calc_time_end - calc_time_start)
-
-    # Close shared memory
-    out_aln_shm.close()
-    base_patterns_shm.close()
-    base_pattern_positions_shm.close()
-
-    ### TIMING
-    if verbose:
         print('Time for JAR preparation:\t' + str(prep_time))
         print('Time for JAR calculation:\t' + str(calc_time))
 
@@ -676,6 +653,7 @@ def reconstruct_alignment_column(column_indices,
 def jar(alignment = None,
         base_patterns = None,
         base_pattern_positions = None,
+        base_pattern_boundaries = None,
         tree_filename = None,
         info_filename = None,
         info_filetype = None,
@@ -714,14 +692,18 @@ def jar(alignment = None,
     # Create rate matrix from f and r
     rm = create_rate_matrix(f,r)
 
-    # Label internal nodes in tree and add these to the new alignment and calculate pij per non-root branch
+    # Root likelihoods use the log base frequencies, which only need to be calculated once
+    log_f = numpy.log(f)
+
+    # Label internal nodes in tree and add these to the new alignment and record branch lengths
     nodecounter=0
     num_nodes = len(tree.nodes())
     node_indices = {}
-    child_nodes_array = numpy.empty(num_nodes, dtype=object)
-    leaf_node_list = []
+    child_node_lists = [[] for node_index in range(num_nodes)]
+    leaf_node_mask = numpy.full(num_nodes, False, dtype = numpy.bool_)
     node_labels = numpy.empty(num_nodes, dtype=object)
-    node_pij = numpy.full((num_nodes,16), numpy.NINF, dtype=numpy.float32)
+    node_pij = numpy.full((num_nodes,4,4), numpy.NINF, dtype=numpy.float32)
+    branch_lengths = numpy.zeros(num_nodes, dtype=numpy.float64)
     postordered_nodes = numpy.arange(num_nodes, dtype=numpy.int32)
     seed_node = None
     seed_node_edge_truncation = True
@@ -751,22 +733,28 @@ def jar(alignment = None,
             # as reconstruction should occur with rooting at a node
             # midpoint rooting causes problems at the root, especially w/JC69
             seed_node_edge_truncation = False
-            node_pij[node_index,:]=calculate_pij(node.edge_length/1e6, rm)
+            branch_lengths[node_index] = node.edge_length/1e6
         else:
-            node_pij[node_index,:]=calculate_pij(node.edge_length, rm)
+            branch_lengths[node_index] = node.edge_length
         # Store information to avoid subsequent recalculation as
         # look up of taxon labels with dendropy is slower than native data structures
         node_label = node.taxon.label
         node_indices[node_label] = node_index
         node_labels[node_index] = node_label
         if node.is_leaf():
-            leaf_node_list.append(node_index)
-            child_nodes_array[node_index] = numpy.full(1, -1, dtype=numpy.int32) # Cannot leave array empty
+            leaf_node_mask[node_index] = True
         else:
-            child_nodes_array[node_index] = numpy.array([node_indices[child.taxon.label] for child in node.child_node_iter()],
-                                                    dtype=numpy.int32)
-    leaf_nodes = numpy.array(leaf_node_list, dtype = numpy.int32)
-    child_nodes = convert_to_square_numpy_array(child_nodes_array)
+            child_node_lists[node_index] = [node_indices[child.taxon.label] for child in node.child_node_iter()]
+    # Store child nodes in compressed form for numba - the children of node i are
+    # child_node_indices[child_node_indptr[i]:child_node_indptr[i+1]]
+    child_node_indptr = numpy.zeros(num_nodes + 1, dtype = numpy.int32)
+    numpy.cumsum([len(child_node_list) for child_node_list in child_node_lists], out = child_node_indptr[1:])
+    child_node_indices = numpy.array([child_node_index for child_node_list in child_node_lists for child_node_index in child_node_list],
+                                     dtype = numpy.int32)
+
+    # Calculate pij per non-root branch from a single decomposition of the rate matrix
+    non_root_nodes = postordered_nodes[postordered_nodes != seed_node]
+    node_pij[non_root_nodes,:,:] = calculate_log_transition_probabilities(branch_lengths[non_root_nodes], rm)
 
     # Store the preordered nodes and record parent node information
     parent_nodes = numpy.full(num_nodes, -1, dtype = numpy.int32)
@@ -777,107 +765,65 @@ def jar(alignment = None,
             preordered_nodes[node_count-1] = node_index # Do not add root node to preordered nodes
             parent_nodes[node_index] = node_indices[node.parent_node.taxon.label]
 
-    # Create new empty array
-    new_aln_array = numpy.full((len(alignment[0]),len(ancestral_node_indices)), '?', dtype = 'U1')
+    # Create new empty array, with one row per ancestral sequence
+    new_aln_array = numpy.full((len(ancestral_node_indices),len(alignment[0])), 4, dtype = numpy.uint8)
 
     # Index names for reconstruction
     ancestral_node_order = numpy.fromiter(ancestral_node_indices.keys(), dtype=numpy.int32)
 
-    # Compile functions prior to multiprocessing
-    for func in [find_most_likely_base_given_descendents,
-                process_leaf,
-                calculate_root_likelihood,
-                count_node_snps,
-                reconstruct_alleles,
-                fill_out_aln,
-                iterate_over_base_patterns]:
-        try:
-            func()
-        except:
-            pass
-
     # Reconstruct each base position
     if verbose:
         print("Reconstructing sites on tree")
 
-    with SharedMemoryManager() as smm:
-    
-        # Convert alignment to shared memory numpy array
-        new_aln_shared_array = generate_shared_mem_array(new_aln_array, smm)
-
-        # Convert base patterns to shared memory numpy array
-        base_patterns_shared_array = generate_shared_mem_array(base_patterns, smm)
-
-        # Convert base pattern positions to shared memory numpy array
-        base_pattern_positions_shared_array = generate_shared_mem_array(base_pattern_positions, smm)
-
-        # split list of sites into chunks per core
-        bp_list = list(range(len(base_patterns)))
-        base_pattern_indices = list(chunks(bp_list,threads))
-
-        # Parallelise reconstructions across alignment columns using multiprocessing
-        with Pool(processes = threads) as pool:
-            reconstruction_results = pool.map(partial(
-                                        reconstruct_alignment_column,
-                                            tree = tree,
-                                            preordered_nodes = preordered_nodes,
-                                            postordered_nodes = postordered_nodes,
-                                            leaf_nodes = leaf_nodes,
-                                            parent_nodes = parent_nodes,
-                                            child_nodes = child_nodes,
-                                            seed_node = seed_node,
-                                            node_pij = node_pij,
-                                            node_index_to_aln_row = node_index_to_aln_row,
-                                            ancestral_node_order = ancestral_node_order,
-                                            base_patterns = base_patterns_shared_array,
-                                            base_pattern_positions = base_pattern_positions_shared_array,
-                                            base_frequencies = f,
-                                            new_aln = new_aln_shared_array,
-                                            threads = threads,
-                                            verbose = verbose),
-                                        base_pattern_indices
-                                    )
-
-        # Write out alignment while shared memory manager still active
-        out_aln_shm = shared_memory.SharedMemory(name = new_aln_shared_array.name)
-        out_aln = numpy.ndarray(new_aln_array.shape, dtype = 'U1', buffer = out_aln_shm.buf)
-        
-        if verbose:
-            print("Printing alignment with internal node sequences: ", output_prefix+".joint.aln")
-        with open(output_prefix+".joint.aln", "w") as asr_output:
-            for taxon in alignment:
-                print(">" + taxon.id, file = asr_output)
-                print(taxon.seq, file = asr_output)
-            for i,node_index in enumerate(ancestral_node_order):
-                taxon = ancestral_node_indices[node_index]
-                asr_output.write('>' + taxon + '\n')
-                asr_output.write(''.join(out_aln[:,i]) + '\n')
-
-        # Release pool nodes
-        pool.join()
-
-        # Combine results for each base across the alignment
-        for node in tree.preorder_node_iter():
-            node.edge_length = 0.0 # reset lengths to convert to SNPs
-            node_index = node_indices[node.taxon.label]
-            for x in range(len(reconstruction_results)):
-                try:
-                    node.edge_length += reconstruction_results[x][node_index];
-                except AttributeError:
-                    continue
-
-        # Print tree
-        from gubbins.common import tree_as_string
-        
-        if verbose:
-            print("Printing tree with internal nodes labelled: ", output_prefix+".joint.tre")
-        with open(output_prefix+".joint.tre", "w") as tree_output:
-        
-            recon_tree = tree_as_string(tree,
-                                        suppress_rooting=True,
-                                        suppress_internal=False)
-            print(recon_tree.replace('\'', ''),
-                  file = tree_output)
+    # Parallelise reconstructions across alignment columns using threads
+    reconstruction_results = reconstruct_alignment_columns(num_nodes = num_nodes,
+                                                            preordered_nodes = preordered_nodes,
+                                                            postordered_nodes = postordered_nodes,
+                                                            leaf_node_mask = leaf_node_mask,
+                                                            parent_nodes = parent_nodes,
+                                                            child_node_indptr = child_node_indptr,
+                                                            child_node_indices = child_node_indices,
+                                                            seed_node = seed_node,
+                                                            node_pij = node_pij,
+                                                            node_index_to_aln_row = node_index_to_aln_row,
+                                                            ancestral_node_order = ancestral_node_order,
+                                                            base_patterns = base_patterns,
+                                                            base_pattern_positions = base_pattern_positions,
+                                                            base_pattern_boundaries = base_pattern_boundaries,
+                                                            log_base_frequencies = log_f,
+                                                            new_aln = new_aln_array,
+                                                            threads = threads,
+                                                            verbose = verbose)
+
+    # Write out alignment
+    if verbose:
+        print("Printing alignment with internal node sequences: ", output_prefix+".joint.aln")
+    with open(output_prefix+".joint.aln", "wb") as asr_output:
+        for taxon in alignment:
+            asr_output.write(('>' + taxon.id + '\n' + str(taxon.seq) + '\n').encode())
+        for i,node_index in enumerate(ancestral_node_order):
+            taxon = ancestral_node_indices[node_index]
+            asr_output.write(('>' + taxon + '\n').encode())
+            asr_output.write(base_decoding_table[new_aln_array[i]].tobytes() + b'\n')
+
+    # Combine results for each base across the alignment
+    branch_snps = reconstruction_results.sum(axis = 0)
+    for node in tree.preorder_node_iter():
+        # reset lengths to convert to SNPs
+        node.edge_length = float(branch_snps[node_indices[node.taxon.label]])
+
+    # Print tree
+    from gubbins.common import tree_as_string
+
+    if verbose:
+        print("Printing tree with internal nodes labelled: ", output_prefix+".joint.tre")
+    with open(output_prefix+".joint.tre", "w") as tree_output:
+
+        recon_tree = tree_as_string(tree,
+                                    suppress_rooting=True,
+                                    suppress_internal=False)
+        print(recon_tree.replace('\'', ''),
+              file = tree_output)
 
     if verbose:
         print("Done")
@@ -0,0 +1,87 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+
+"""
+Tests of the joint ancestral reconstruction with no external application dependencies.
+"""
+
+import unittest
+import os
+import tempfile
+import numpy
+from scipy import linalg
+from Bio.Align import MultipleSeqAlignment
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from gubbins import pyjar
+
+
+class TestPyjar(unittest.TestCase):
+
+    def test_calculate_log_transition_probabilities(self):
+        branch_lengths = numpy.array([0.0, 1e-20, 1e-15, 1e-12, 1e-9, 1e-6, 0.001, 0.1, 1.0, 10.0])
+        models = [([0.25, 0.25, 0.25, 0.25], [1.0, 1.0, 1.0, 1.0, 1.0, 1.0]),
+                  ([0.1, 0.2, 0.3, 0.4], [1.0, 2.0, 3.0, 0.5, 1.5, 1.0]),
+                  ([0.35, 0.15, 0.15, 0.35], [0.8, 4.2, 0.6, 1.1, 3.9, 1.0])]
+        for f,r in models:
+            rm = pyjar.create_rate_matrix(numpy.array(f), numpy.array(r))
+            pij = pyjar.calculate_log_transition_probabilities(branch_lengths, rm)
+            assert pij.shape == (branch_lengths.size, 4, 4)
+            assert pij.dtype == numpy.float32
+            for i,t in enumerate(branch_lengths):
+                # Zero probabilities are floored to keep log likelihoods finite
+                expected = numpy.log(numpy.maximum(linalg.expm(t*rm), 1e-300))
+                numpy.testing.assert_allclose(pij[i], expected, rtol = 1e-6, atol = 1e-6)
+            # Zero-length branches do not allow any change of base
+            assert numpy.all(pij[0][numpy.identity(4) == 0] < -690)
+            assert numpy.all(pij[0][numpy.identity(4) == 1] == 0)
+
+    def test_calculate_log_transition_probabilities_shared_lengths(self):
+        rm = pyjar.create_rate_matrix(numpy.array([0.1, 0.2, 0.3, 0.4]),
+                                      numpy.array([1.0, 2.0, 3.0, 0.5, 1.5, 1.0]))
+        pij = pyjar.calculate_log_transition_probabilities(numpy.array([0.5, 0.01, 0.5]), rm)
+        assert numpy.array_equal(pij[0], pij[2])
+        assert not numpy.array_equal(pij[0], pij[1])
+
+    def test_get_base_patterns(self):
+        alignment = MultipleSeqAlignment([SeqRecord(Seq('ACNA-N-'), id = 'sequence1'),
+                                          SeqRecord(Seq('AG-AN-N'), id = 'sequence2'),
+                                          SeqRecord(Seq('TGGTN-G'), id = 'sequence3')])
+        base_patterns, base_pattern_positions, base_pattern_boundaries = pyjar.get_base_patterns(alignment, False)
+        # N and - are both unknown bases, so columns differing only in these share a pattern
+        assert numpy.array_equal(base_patterns, numpy.array([[0, 0, 3],
+                                                             [1, 2, 2],
+                                                             [4, 4, 2],
+                                                             [4, 4, 4]], dtype = numpy.uint8))
+        assert numpy.array_equal(base_pattern_boundaries, numpy.array([0, 2, 3, 5, 7]))
+        positions = [base_pattern_positions[base_pattern_boundaries[i]:base_pattern_boundaries[i+1]].tolist()
+                     for i in range(len(base_patterns))]
+        assert positions == [[0, 3], [1], [2, 6], [4, 5]]
+        assert base_pattern_positions.dtype == numpy.int32
+        assert base_pattern_boundaries.dtype == numpy.int32
+
+    def test_jar(self):
+        alignment = MultipleSeqAlignment([SeqRecord(Seq('AACT-'), id = 'sequence1'),
+                                          SeqRecord(Seq('AACTN'), id = 'sequence2'),
+                                          SeqRecord(Seq('AGGT-'), id = 'sequence3'),
+                                          SeqRecord(Seq('AGGA-'), id = 'sequence4')])
+        base_patterns, base_pattern_positions, base_pattern_boundaries = pyjar.get_base_patterns(alignment, False)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tree_filename = os.path.join(tmp_dir, 'input.tre')
+            with open(tree_filename, 'w') as tree_file:
+                tree_file.write('((sequence1:0.1,sequence2:0.1):0.1,(sequence3:0.1,sequence4:0.1):0.1);\n')
+            output_prefix = os.path.join(tmp_dir, 'output')
+            pyjar.jar(alignment = alignment,
+                      base_patterns = base_patterns,
+                      base_pattern_positions = base_pattern_positions,
+                      base_pattern_boundaries = base_pattern_boundaries,
+                      tree_filename = tree_filename,
+                      info_filename = '',
+                      info_filetype = 'raxml',
+                      output_prefix = output_prefix,
+                      threads = 2)
+            with open(output_prefix + '.joint.aln', 'r') as aln_file:
+                assert aln_file.read() == '>sequence1\nAACT-\n>sequence2\nAACTN\n>sequence3\nAGGT-\n>sequence4\nAGGA-\n' \
+                                          '>Node_1\nAACT-\n>Node_2\nAGGT-\n>Node_3\nAACT-\n'
+            with open(output_prefix + '.joint.tre', 'r') as tree_file:
+                assert tree_file.read().strip() == '((sequence1:0.0,sequence2:0.0)Node_1:0.0,(sequence3:0.0,sequence4:1.0)Node_2:2.0)Node_3:0.0;'
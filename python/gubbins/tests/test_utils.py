@@ -10,6 +10,7 @@ import os
 import subprocess
 import re
 import io
+import tempfile
 from contextlib import redirect_stdout
 from gubbins import common, utils
 
@@ -65,6 +66,42 @@ class TestUtilities(unittest.TestCase):
         assert utils.is_executable(program)
         assert not utils.is_executable('non_existent_program')
 
+    def test_get_cpu_flags(self):
+        # Processor flags are only read once
+        flags = utils.get_cpu_flags()
+        assert flags is utils.get_cpu_flags()
+        assert 'flags' not in flags
+        assert ':' not in flags
+        # Other lists of flags, such as those for virtualisation, are not included
+        assert utils.parse_cpu_flags(['flags\t\t: fpu AVX2 sse3\n', 'vmx flags\t: vnmi ept\n'], 'flags') == \
+               {'fpu', 'avx2', 'sse3'}
+        if os.path.exists('/proc/cpuinfo'):
+            with open('/proc/cpuinfo', 'r') as cpuinfo_file:
+                cpuinfo = cpuinfo_file.readlines()
+            vmx_only_flags = utils.parse_cpu_flags(cpuinfo, 'vmx flags') - utils.parse_cpu_flags(cpuinfo, 'flags')
+            assert flags.isdisjoint(vmx_only_flags)
+
+    def test_choose_executable_based_on_processor(self):
+        assert utils.choose_executable_based_on_processor(['non_existent_program', 'ls']) == 'ls'
+        assert utils.choose_executable_based_on_processor(['ls', 'non_existent_program']) is None
+        # Executables are chosen according to the processor flags
+        original_cpu_flags = utils.get_cpu_flags()
+        original_path = os.environ['PATH']
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for executable in ['program-AVX2', 'program']:
+                executable_path = os.path.join(tmp_dir, executable)
+                open(executable_path, 'w').close()
+                os.chmod(executable_path, 0o755)
+            os.environ['PATH'] = tmp_dir + os.pathsep + original_path
+            try:
+                utils.cpu_flags = {'avx2'}
+                assert utils.choose_executable_based_on_processor(['program-AVX2', 'program']) == 'program-AVX2'
+                utils.cpu_flags = {'sse3'}
+                assert utils.choose_executable_based_on_processor(['program-AVX2', 'program']) == 'program'
+            finally:
+                utils.cpu_flags = original_cpu_flags
+                os.environ['PATH'] = original_path
+
     def test_replace_executable(self):
         assert 'raxmlHPC -f d -p 1 -m GTRGAMMA' in utils.replace_executable('raxml -f d -p 1 -m GTRGAMMA', 'raxmlHPC')
         assert '../src/gubbins' in utils.replace_executable('gubbins', '../src/gubbins')
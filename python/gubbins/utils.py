@@ -21,14 +21,6 @@ import os
 import shutil
 import subprocess
 import re
-import numpy as np
-import collections
-try:
-    from multiprocessing.managers import SharedMemoryManager
-    NumpyShared = collections.namedtuple('NumpyShared', ('name', 'shape', 'dtype'))
-except ImportError as e:
-    sys.stderr.write("This version of Gubbins requires python v3.8 or higher\n")
-    sys.exit(0)
 
 class VerbosePrinter:
     """Class printing messages if verbose argument is set"""
@@ -94,20 +86,38 @@ def choose_executable(list_of_executables: list):
     return None
 
 
+# Processor feature flags, read once on first use
+cpu_flags = None
+
+def parse_cpu_flags(lines, key):
+    """Returns the set of flags listed on lines of the form 'key : flag flag ...'"""
+    flags = set()
+    for line in lines:
+        name, _, values = line.partition(':')
+        if name.strip() == key:
+            flags.update(values.lower().split())
+    return flags
+
+def get_cpu_flags():
+    """Returns the set of processor feature flags, which is empty if these cannot be determined"""
+    global cpu_flags
+    if cpu_flags is None:
+        if os.path.exists('/proc/cpuinfo'):
+            with open('/proc/cpuinfo', 'r') as cpuinfo_file:
+                cpu_flags = parse_cpu_flags(cpuinfo_file, 'flags')
+        elif which("sysctl") is not None:
+            output = subprocess.Popen('sysctl -a | grep machdep.cpu.features',
+                                      stdout=subprocess.PIPE,
+                                      shell=True).communicate()[0].decode("utf-8")
+            cpu_flags = parse_cpu_flags(output.splitlines(), 'machdep.cpu.features')
+        else:
+            cpu_flags = set()
+    return cpu_flags
+
 def choose_executable_based_on_processor(list_of_executables: list):
     """Chooses an executable from a list and thereby takes into account processor features"""
-    flags = []
-    cpu_info = False
-    if os.path.exists('/proc/cpuinfo'):
-        cpu_info = True
-        output = subprocess.Popen('grep flags /proc/cpuinfo', stdout=subprocess.PIPE,
-                                  shell=True).communicate()[0].decode("utf-8")
-    elif which("sysctl") is not None:
-        cpu_info = True
-        output = subprocess.Popen('sysctl -a | grep machdep.cpu.features',
-                                  stdout=subprocess.PIPE,
-                                  shell=True).communicate()[0].decode("utf-8")
-    flags = output.lower().split()
+    flags = get_cpu_flags()
+    cpu_info = len(flags) > 0
 
     # Iterate through list to match with CPU features
     for executable in list_of_executables:
@@ -135,31 +145,33 @@ def replace_executable(command, alternative_executable):
     return " ".join(executable_and_params)
 
 
+def matching_files(directory, basenames, suffix_regex):
+    """Yields the paths of files in a directory with a given name structure"""
+    if len(basenames) == 0:
+        return
+    regex = re.compile("^(" + "|".join(re.escape(basename) for basename in basenames) + ")" + suffix_regex)
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if regex.match(entry.name) is not None:
+                yield entry.path
+
+
 def do_files_exist(directory, basenames, suffix_regex, verbose=False):
     """Checks if files with a given name structure exist"""
-    files = os.listdir(directory)
-    for file in files:
-        full_path = os.path.join(directory, file)
-        for basename in basenames:
-            regex = "^" + basename + suffix_regex
-            if re.match(regex, file) is not None and os.path.exists(full_path):
-                if verbose:
-                    print("File exists: " + full_path)
-                return True
+    for full_path in matching_files(directory, basenames, suffix_regex):
+        if verbose:
+            print("File exists: " + full_path)
+        return True
     return False
 
 
 def delete_files(directory, basenames, suffix_regex, verbose=False):
     """Deletes files with a given name structure"""
-    files = os.listdir(directory)
-    for file in files:
-        full_path = os.path.join(directory, file)
-        for basename in basenames:
-            regex = "^" + basename + suffix_regex
-            if re.match(regex, file) is not None and os.path.exists(full_path):
-                if verbose:
-                    print("Deleting file: " + full_path)
-                os.remove(full_path)
+    # Collect matches before deleting, so the directory is not modified while being scanned
+    for full_path in list(matching_files(directory, basenames, suffix_regex)):
+        if verbose:
+            print("Deleting file: " + full_path)
+        os.remove(full_path)
 
 
 def rename_files(input_to_output_filenames):
@@ -167,11 +179,3 @@ def rename_files(input_to_output_filenames):
     for input_file, output_file in input_to_output_filenames.items():
         if os.path.exists(input_file):
             shutil.move(input_file, output_file)
-
-def generate_shared_mem_array(in_array, smm):
-    """Generates a shared memory representation of a numpy array"""
-    array_raw = smm.SharedMemory(size = in_array.nbytes)
-    array_shared = np.ndarray(in_array.shape, dtype = in_array.dtype, buffer = array_raw.buf)
-    array_shared[:] = in_array[:]
-    array_shared = NumpyShared(name = array_raw.name, shape = in_array.shape, dtype = in_array.dtype)
-    return(array_shared)
@@ -46,7 +46,6 @@ setuptools.setup(
         "biopython >= 1.59",
         "dendropy  >= 4.0.2",
         "multiprocess >= 0.70",
-        "scipy >= 1.5.3",
         "numpy >= 1.19"
     ],
     license="GPL"